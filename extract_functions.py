@@ -1,9 +1,197 @@
-import ast
-import pandas as pd
 import pyarrow as pa
 import os
 import pyarrow.parquet as pq
 import glob
+import hashlib
+import pickle
+from importlib import metadata
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import tree_sitter_python as tspython
+from tree_sitter import Language, Parser
+from parquet_options import FUNCTIONS_ROW_GROUP_SIZE, FILES_ROW_GROUP_SIZE, FUNCTIONS_WRITE_OPTIONS, FILES_WRITE_OPTIONS
+
+# columns of the python files parquet needed to extract functions
+INPUT_COLUMNS = ['content', 'file_path', 'repo_name', 'repo_url']
+# minimum number of rows in a parquet file before parsing it with a process pool
+PARALLEL_MIN_ROWS = 256
+# tree-sitter python grammar, the parser itself is created per process by _get_parser
+PY_LANGUAGE = Language(tspython.language())
+_parser = None
+# tree-sitter node types that can contain function definitions
+SCOPE_NODE_TYPES = frozenset([
+    'function_definition', 'class_definition', 'decorated_definition', 'block',
+    'if_statement', 'elif_clause', 'else_clause', 'for_statement', 'while_statement',
+    'try_statement', 'except_clause', 'except_group_clause', 'finally_clause',
+    'with_statement', 'match_statement', 'case_clause',
+])
+# python 2 statements the grammar still parses, files using them are skipped like ast.parse did
+PY2_STATEMENT_TYPES = frozenset(['print_statement', 'exec_statement'])
+# directory caching the parsed functions of each file content between runs
+FUNCTIONS_CACHE_DIR = 'functions_cache'
+# sub directory of the cache for the current parser, grammar version and revision of _parse_functions,
+# so results of earlier parsers are not reused. bump the revision when the parsing changes
+PARSE_CACHE_TAG = f"tree-sitter-python-{metadata.version('tree-sitter-python')}-2"
+# columns of the functions parquet
+FUNCTIONS_SCHEMA = pa.schema([
+    ('function_name', pa.string()),
+    ('function_code', pa.string()),
+    ('code_length', pa.int64()),
+    ('file_path', pa.string()),
+    ('repo_name', pa.string()),
+    ('repo_url', pa.string()),
+])
+FUNCTION_COLUMNS = FUNCTIONS_SCHEMA.names
+
+'''
+get the tree-sitter parser of this process, parsers can not be shared between processes
+so each worker creates its own on first use
+'''
+def _get_parser():
+    global _parser
+    if _parser is None:
+        _parser = Parser(PY_LANGUAGE)
+    return _parser
+
+'''
+get the last token of a node that is not a comment. tree-sitter puts comments after the
+last statement of a block inside the block, ast ends the function at its last statement
+'''
+def _last_token(node):
+    while node.child_count:
+        children = [child for child in node.children if child.type != 'comment']
+        if not children:
+            break
+        node = children[-1]
+    return node
+
+'''
+parse the functions of a single python file content
+    paramters:
+        file_content: the content of the python file
+        threshold: the threshold of code length, if the code length of a function is larger than the threshold, it will be ignored
+    return: a list of (function name, function code, code length), empty if the file can not be parsed or is python 2
+'''
+def _parse_functions(file_content, threshold = None):
+    functions = []
+    source = file_content.encode()
+    tree = _get_parser().parse(source)
+    # tree-sitter recovers from syntax errors, skip these files like ast.parse would
+    if tree.root_node.has_error:
+        return functions
+    # only visit nodes that can contain function definitions
+    stack = [tree.root_node]
+    while stack:
+        node = stack.pop()
+        if node.type == 'function_definition':
+            end = _last_token(node)
+            length = end.end_point[0] - node.start_point[0] + 1
+            # check the threshold before cutting out the source
+            if not threshold or length <= threshold:
+                name = node.child_by_field_name('name')
+                func_name = source[name.start_byte:name.end_byte].decode()
+                func_code = source[node.start_byte:end.end_byte].decode()
+                functions.append((func_name, func_code, length))
+        children = node.named_children
+        # every statement is a child of a visited node, python 2 files are found during the walk
+        if any(child.type in PY2_STATEMENT_TYPES for child in children):
+            return []
+        # push in reverse so functions come out in source order
+        stack.extend(reversed([child for child in children if child.type in SCOPE_NODE_TYPES]))
+    return functions
+
+'''
+parse the functions of a single python file content, reusing the result of an earlier run
+on the same content if it is in the cache directory
+    paramters:
+        file_content: the content of the python file
+        cache_dir: the directory storing the parsed functions, keyed by PARSE_CACHE_TAG and the hash of the content
+    return: a list of (function name, function code, code length) of every function in the file
+'''
+def _cached_parse_functions(file_content, cache_dir):
+    key = hashlib.blake2b(file_content.encode(), digest_size=16).hexdigest()
+    cache_path = os.path.join(cache_dir, PARSE_CACHE_TAG, f'{key}.pkl')
+    try:
+        with open(cache_path, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+    # cache every function, the threshold is applied by the caller
+    functions = _parse_functions(file_content)
+    # write to a temporary file first, other processes may read the same key
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(functions, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, cache_path)
+    return functions
+
+'''
+extract functions from a single python file content
+    paramters:
+        file_content: the content of the python file
+        file_path: the path of the file in its repository
+        repo_name: the repository name
+        repo_url: the repository url
+        threshold: the threshold of code length, if the code length of a function is larger than the threshold, it will be ignored
+        cache_dir: the directory caching parsed files, None to always parse
+    return: a list of functions as tuples in FUNCTION_COLUMNS order, empty if the file can not be parsed
+'''
+def _extract_one(file_content, file_path, repo_name, repo_url, threshold = None, cache_dir = None):
+    if cache_dir:
+        functions = [function for function in _cached_parse_functions(file_content, cache_dir)
+                     if not threshold or function[2] <= threshold]
+    else:
+        functions = _parse_functions(file_content, threshold)
+    return [(func_name, func_code, length, file_path, repo_name, repo_url)
+            for func_name, func_code, length in functions]
+
+'''
+extract functions from every python file in a parquet file, one python file at a time
+    paramters:
+        parquet_path: the parquet storing python files content
+        threshold: the threshold of code length, if the code length of a function is larger than the threshold, it will be ignored
+        batch_size: number of rows read from the parquet file at a time
+        max_workers: number of processes parsing files, files with fewer than PARALLEL_MIN_ROWS rows are parsed in this process
+        cache_dir: the directory caching parsed files, None to always parse
+    return: a generator of the functions of each python file, as returned by _extract_one
+'''
+def _iter_file_functions(parquet_path, threshold = None, batch_size = 1000, max_workers = None, cache_dir = None):
+    parquet_file = pq.ParquetFile(parquet_path)
+    if cache_dir:
+        os.makedirs(os.path.join(cache_dir, PARSE_CACHE_TAG), exist_ok=True)
+    if max_workers is None:
+        max_workers = os.cpu_count()
+    # forking workers costs more than parsing a handful of files
+    executor = None
+    if max_workers > 1 and parquet_file.metadata.num_rows >= PARALLEL_MIN_ROWS:
+        executor = ProcessPoolExecutor(max_workers=max_workers)
+    try:
+        # only read the columns we need, one batch of rows at a time
+        for batch in parquet_file.iter_batches(batch_size=batch_size, columns=INPUT_COLUMNS):
+            contents = batch.column('content').to_pylist()
+            file_paths = batch.column('file_path').to_pylist()
+            repo_names = batch.column('repo_name').to_pylist()
+            repo_urls = batch.column('repo_url').to_pylist()
+            thresholds = repeat(threshold, len(contents))
+            cache_dirs = repeat(cache_dir, len(contents))
+            if executor:
+                yield from executor.map(_extract_one, contents, file_paths, repo_names, repo_urls, thresholds, cache_dirs, chunksize=64)
+            else:
+                yield from map(_extract_one, contents, file_paths, repo_names, repo_urls, thresholds, cache_dirs)
+    finally:
+        if executor:
+            executor.shutdown()
+
+'''
+turn a list of function tuples into a dict from column name to the list of its values
+'''
+def _to_columns(rows, columns = None):
+    if columns is None:
+        columns = {column: [] for column in FUNCTION_COLUMNS}
+    for column, values in zip(FUNCTION_COLUMNS, zip(*rows)):
+        columns[column].extend(values)
+    return columns
+
 '''
 extract functions from python files and creating a new parequet file with columns:
     1. function name
@@ -16,49 +204,79 @@ extract functions from python files and creating a new parequet file with column
     paramters:
         parquet_path: the parquet storing python files content
         threshold: the threshold of code length, if the code length of a function is larger than the threshold, it will be ignored
+        batch_size: number of rows read from the parquet file at a time
+        max_workers: number of processes parsing files, files with fewer than PARALLEL_MIN_ROWS rows are parsed in this process
+        cache_dir: the directory caching parsed files, None to always parse
+    return: a dict from column name to the list of its values
 
 '''
-def extract_functions_from_file(parquet_path, threshold = None):
-    df = pd.read_parquet(parquet_path)
-    functions = []
-    for index, cur_file in df.iterrows():
-        file_content = cur_file['content']
-        try:
-            tree = ast.parse(file_content)
-        except SyntaxError as e:
-            #print(f"Syntax error in file at index {index}: {e}")
-            continue
-        for node in ast.walk(tree):
-            if isinstance(node, ast.FunctionDef):
-                length = node.lineno
-                if threshold and length > threshold:
-                    continue
-                func_name = node.name
-                func_code = ast.get_source_segment(file_content, node)
-                functions.append({
-                    'function_name': func_name,
-                    'function_code': func_code,
-                    'code_length': node.lineno,
-                    'file_path': cur_file['file_path'],
-                    'repo_name': cur_file['repo_name'],
-                    'repo_url': cur_file['repo_url'],
-                })
-        
+def extract_functions_from_file(parquet_path, threshold = None, batch_size = 1000, max_workers = None, cache_dir = None):
+    # one list per column, so the table can be built without pandas
+    functions = {column: [] for column in FUNCTION_COLUMNS}
+    for rows in _iter_file_functions(parquet_path, threshold, batch_size, max_workers, cache_dir):
+        _to_columns(rows, functions)
+
     return functions
 
 '''
 save the functions table to a parquet file
 parameters:
     parent_dir: parent directory to save the parquet file
-    functions_table: the table with functions information
+    functions_table: the table with functions information, a dict from column name to the list of its values
     save_path: the detailed path to save the parquet file
 '''
 def save_parquet_file(parent_dir, functions_table, save_path):
     if not os.path.exists(parent_dir):
         os.makedirs(parent_dir)
-    df = pd.DataFrame(functions_table)
-    table = pa.Table.from_pandas(df)
-    pq.write_table(table, f'{parent_dir}/{save_path}')
+    table = pa.table(functions_table, schema=FUNCTIONS_SCHEMA)
+    pq.write_table(table, f'{parent_dir}/{save_path}', row_group_size=FUNCTIONS_ROW_GROUP_SIZE, **FUNCTIONS_WRITE_OPTIONS)
+
+'''
+extract functions from python files and write them to a parquet file as they are found,
+instead of collecting every function of the file in memory first
+parameters:
+    parquet_path: the parquet storing python files content
+    parent_dir: parent directory to save the parquet file
+    save_path: the detailed path to save the parquet file
+    threshold: the threshold of code length, if the code length of a function is larger than the threshold, it will be ignored
+    batch_size: number of rows read from the parquet file at a time
+    max_workers: number of processes parsing files
+    write_batch_size: number of functions written to the parquet file at a time, each write is one row group
+    cache_dir: the directory caching parsed files, None to always parse
+return: the number of functions written
+'''
+def write_functions_file(parquet_path, parent_dir, save_path, threshold = None, batch_size = 1000,
+                         max_workers = None, write_batch_size = FUNCTIONS_ROW_GROUP_SIZE, cache_dir = None):
+    # several processes may create the same directory at once
+    os.makedirs(parent_dir, exist_ok=True)
+    total = 0
+    buffer = []
+    with pq.ParquetWriter(f'{parent_dir}/{save_path}', FUNCTIONS_SCHEMA, **FUNCTIONS_WRITE_OPTIONS) as writer:
+        for rows in _iter_file_functions(parquet_path, threshold, batch_size, max_workers, cache_dir):
+            buffer.extend(rows)
+            if len(buffer) >= write_batch_size:
+                writer.write_batch(pa.RecordBatch.from_pydict(_to_columns(buffer), schema=FUNCTIONS_SCHEMA))
+                total += len(buffer)
+                buffer = []
+        if buffer:
+            writer.write_batch(pa.RecordBatch.from_pydict(_to_columns(buffer), schema=FUNCTIONS_SCHEMA))
+            total += len(buffer)
+    return total
+
+'''
+extract the functions of one python files parquet of a query directory into its functions directory,
+used by the process pool of the main loop. files are already processed in parallel, so a single
+file is parsed in the worker process itself
+parameters:
+    task: tuple of the query directory and the python files parquet path
+'''
+def _process_file(task):
+    query_dir, file_path = task
+    #threshold = 100
+    save_path = os.path.basename(file_path)
+    write_functions_file(file_path, f'{query_dir}/functions', save_path, max_workers=1,
+                         cache_dir=FUNCTIONS_CACHE_DIR)
+    print(f'Finished processing {query_dir}/functions/{save_path}')
 
 '''
 merge parquet chunk files into one file by given path
@@ -78,30 +296,58 @@ def merge_parquet_files(base_dir, given_path, output_path):
         print(f"No parquet files found with given path: {given_path}")
         return
 
-    combined_df = pd.concat([pd.read_parquet(file) for file in parquet_files])
-
-    combined_df.to_parquet(output_path, index=False)
+    # append the chunks one row group at a time, small row groups of the chunks are buffered
+    # until they fill an output row group, so at most about two row groups are held in memory.
+    # empty chunks are skipped, they are written without columns
+    writer = None
+    buffered = []
+    buffered_rows = 0
+    try:
+        for parquet_file in parquet_files:
+            reader = pq.ParquetFile(parquet_file)
+            if reader.metadata.num_rows == 0:
+                continue
+            for i in range(reader.num_row_groups):
+                row_group = reader.read_row_group(i)
+                if writer is None:
+                    writer = pq.ParquetWriter(output_path, row_group.schema, **FILES_WRITE_OPTIONS)
+                buffered.append(row_group)
+                buffered_rows += row_group.num_rows
+                if buffered_rows < FILES_ROW_GROUP_SIZE:
+                    continue
+                # write the full row groups and keep the rest for the next chunks
+                table = pa.concat_tables(buffered)
+                full_rows = buffered_rows - buffered_rows % FILES_ROW_GROUP_SIZE
+                writer.write_table(table.slice(0, full_rows), row_group_size=FILES_ROW_GROUP_SIZE)
+                buffered = [table.slice(full_rows)]
+                buffered_rows -= full_rows
+        if buffered_rows:
+            writer.write_table(pa.concat_tables(buffered), row_group_size=FILES_ROW_GROUP_SIZE)
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        print(f"No rows found in parquet files with given path: {given_path}")
+        return
     print(f"Combined parquet file saved to: {output_path}")
 
-# list of directores to process
-query_directories = ['blog', 'data_visualization', 'ecommerce', 'social_media']
-for query_dir in query_directories:
-    # merge parquet chunk files to one combined file
-    base_directory = f'{query_dir}/files_in_chunk'
-    search_path_beforegpt = '2021'
-    search_path_aftergpt = '2023'
-    output_file_path_beforegpt = f'{query_dir}/merged_files/{search_path_beforegpt}.parquet'
-    output_file_path_aftergpt = f'{query_dir}/merged_files/{search_path_aftergpt}.parquet'
-    if not os.path.exists(f'{query_dir}/merged_files'):
-        os.makedirs(f'{query_dir}/merged_files')
-    merge_parquet_files(base_directory, search_path_beforegpt, output_file_path_beforegpt)
-    merge_parquet_files(base_directory, search_path_aftergpt, output_file_path_aftergpt)
-
-    # get python file parquet paths
-    parquet_files = glob.glob(os.path.join(f'{query_dir}/files', '*.parquet'))
-    for file_path in parquet_files:
-        #threshold = 100
-        functions_table = extract_functions_from_file(file_path)
-        save_path = os.path.basename(file_path) 
-        save_parquet_file(f'{query_dir}/functions', functions_table, save_path)
-        print(f'Finished processing {query_dir}/functions/{save_path}')
\ No newline at end of file
+if __name__ == '__main__':
+    # list of directores to process
+    query_directories = ['blog', 'data_visualization', 'ecommerce', 'social_media']
+    for query_dir in query_directories:
+        # merge parquet chunk files to one combined file
+        base_directory = f'{query_dir}/files_in_chunk'
+        search_path_beforegpt = '2021'
+        search_path_aftergpt = '2023'
+        output_file_path_beforegpt = f'{query_dir}/merged_files/{search_path_beforegpt}.parquet'
+        output_file_path_aftergpt = f'{query_dir}/merged_files/{search_path_aftergpt}.parquet'
+        if not os.path.exists(f'{query_dir}/merged_files'):
+            os.makedirs(f'{query_dir}/merged_files')
+        merge_parquet_files(base_directory, search_path_beforegpt, output_file_path_beforegpt)
+        merge_parquet_files(base_directory, search_path_aftergpt, output_file_path_aftergpt)
+
+    # get python file parquet paths of every directory, and process the files in parallel
+    tasks = [(query_dir, file_path) for query_dir in query_directories
+             for file_path in glob.glob(os.path.join(f'{query_dir}/files', '*.parquet'))]
+    with ProcessPoolExecutor() as executor:
+        list(executor.map(_process_file, tasks))
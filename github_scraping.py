@@ -1,5 +1,9 @@
-import requests
+import requests_cache
+from requests_cache import DO_NOT_CACHE, EXPIRE_IMMEDIATELY
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
+import orjson
 import os
 import pandas as pd
 import pyarrow as pa
@@ -7,9 +11,81 @@ import pyarrow.parquet as pq
 from datetime import datetime
 from pathlib import Path
 import re
-import base64
 import time
 from collections import deque
+import asyncio
+import httpx
+import hishel
+import hishel.httpx
+# the chunk parquets are written like the merged files parquet
+from parquet_options import FILES_ROW_GROUP_SIZE, FILES_WRITE_OPTIONS
+
+GRAPHQL_URL = 'https://api.github.com/graphql'
+# sqlite file caching the GitHub responses between runs
+HTTP_CACHE_NAME = 'gh_cache'
+# sqlite file caching the responses of the async REST walk, hishel keeps it under .cache/hishel
+ASYNC_HTTP_CACHE_PATH = f'{HTTP_CACHE_NAME}_async.sqlite'
+# media type asking the contents API for the raw file
+RAW_MEDIA_TYPE = 'application/vnd.github.raw'
+# virtual environment directories like venv2 or env3
+ENV_DIR_RE = re.compile(r'^(?:venv|env)\d+$')
+# levels of directories returned by one tree query
+GRAPHQL_TREE_DEPTH = 3
+# files whose last commit is asked for in one query
+GRAPHQL_HISTORY_BATCH = 50
+# files whose text is asked for in one query, and their total size in bytes
+GRAPHQL_BLOB_BATCH = 50
+GRAPHQL_BLOB_BATCH_BYTES = 4 * 1024 * 1024
+
+'''
+    Build the GraphQL query of a directory tree, with the sha and size of the files
+    and the sub directories down to the given depth. the text is asked for by _blob_query,
+    only for the files that are kept
+'''
+def _tree_query(depth):
+    blob = '... on Blob { oid isBinary byteSize }'
+    selection = blob
+    for _ in range(depth):
+        selection = f'{blob} ... on Tree {{ entries {{ name path type object {{ {selection} }} }} }}'
+    return ('query($owner: String!, $name: String!, $expression: String!) {'
+            f' repository(owner: $owner, name: $name) {{ object(expression: $expression) {{ {selection} }} }} }}')
+
+GRAPHQL_TREE_QUERY = _tree_query(GRAPHQL_TREE_DEPTH)
+
+'''
+    Build the GraphQL query of the last commit of count files, the paths are passed as
+    variables p0, p1, ... and the commits are returned as f0, f1, ...
+'''
+def _history_query(count):
+    variables = ''.join(f', $p{i}: String!' for i in range(count))
+    fields = ' '.join(f'f{i}: history(first: 1, path: $p{i}) {{ nodes {{ committedDate }} }}' for i in range(count))
+    return (f'query($owner: String!, $name: String!{variables}) {{'
+            f' repository(owner: $owner, name: $name) {{ object(expression: "HEAD") {{ ... on Commit {{ {fields} }} }} }} }}')
+
+'''
+    Build the GraphQL query of the text of count files, the expressions (HEAD:path) are passed as
+    variables p0, p1, ... and the files are returned as f0, f1, ...
+'''
+def _blob_query(count):
+    variables = ''.join(f', $p{i}: String!' for i in range(count))
+    fields = ' '.join(f'f{i}: object(expression: $p{i}) {{ ... on Blob {{ text isTruncated }} }}' for i in range(count))
+    return (f'query($owner: String!, $name: String!{variables}) {{'
+            f' repository(owner: $owner, name: $name) {{ {fields} }} }}')
+
+'''
+    Keep only the code cells of a jupyter notebook, joined into one python source,
+    so the markdown, outputs and images of the notebook are not stored.
+    Lines of IPython magics and shell commands are commented out so the source can be parsed.
+    returns None if the notebook can not be read
+'''
+def notebook_to_source(notebook):
+    try:
+        cells = orjson.loads(notebook)['cells']
+        sources = [''.join(cell.get('source', '')) for cell in cells if cell.get('cell_type') == 'code']
+    except (orjson.JSONDecodeError, KeyError, TypeError, AttributeError):
+        return None
+    lines = '\n'.join(sources).split('\n')
+    return '\n'.join(f'# {line}' if line.startswith(('%', '!')) else line for line in lines)
 
 '''
     Scraping Github repositories and creating a parquet file with columns:
@@ -31,15 +107,22 @@ from collections import deque
         afterGPT: True if we want to scrape repositories after ChatGPT was released
         download_limit: Number of repositories to download
         additional_query: Additional query parameters to search for
+        use_graphql: Fetch the files with the GraphQL API after ChatGPT, falls back to the REST API if it fails
         
 '''
 def github_scraping(token, language, file_extension, time_year, time_start_month, time_end_month,
-                    parent_dir, file_name, afterGPT, ignore_filedir, download_limit = 1, additional_query = ''):
+                    parent_dir, file_name, afterGPT, ignore_filedir, download_limit = 1, additional_query = '',
+                    use_graphql = True):
     # format variables
     time_start_month = str(time_start_month).zfill(2)
     time_end_month = str(time_end_month).zfill(2)
     if not isinstance(file_extension, list):
         file_extension = [file_extension]
+    # str.endswith takes a tuple of suffixes
+    file_extension = tuple(file_extension)
+    ignore_set = frozenset(ignore_filedir)
+    # blob shas already downloaded, the same stock files show up in many repositories
+    seen_shas = set()
 
     if not isinstance(token, list):
         token = [token]
@@ -50,13 +133,40 @@ def github_scraping(token, language, file_extension, time_year, time_start_month
         header = {'Authorization': f'token {t}'}
         header_queue.append(header)
     headers = {'Authorization': f'token {token[0]}'}
+    # requests of a repository in flight at once, the requests are
+    # limited per token so this grows with the number of tokens
+    max_workers = 8 * len(token)
+    # one session for the requests sent one at a time from the chunk loop: the search, rate limit and
+    # GraphQL requests, and the raw files too large for GraphQL. connections are reused instead of
+    # doing a new TLS handshake per request. responses are cached on disk and
+    # revalidated with their ETag, a 304 does not count against the rate limit.
+    # the search and rate limit cache rules below are set per url on this session, the concurrent
+    # REST walk can not use a blocking session without a thread per request and has its own client
+    session = requests_cache.CachedSession(HTTP_CACHE_NAME, backend='sqlite', expire_after=86400, cache_control=True,
+                                           allowable_codes=(200, 404), match_headers=['Accept'],
+                                           urls_expire_after={'api.github.com/rate_limit': DO_NOT_CACHE,
+                                                              # revalidated with their ETag on every call
+                                                              'api.github.com/search': EXPIRE_IMMEDIATELY})
+    adapter = HTTPAdapter(pool_connections=32, pool_maxsize=max(32, max_workers),
+                          max_retries=Retry(total=5, backoff_factor=0.5, status_forcelist=[502, 503, 504]))
+    session.mount('https://', adapter)
+    # one event loop and one HTTP/2 client for the REST walk of every repository, so connections
+    # are reused across repositories. responses are cached on disk and revalidated with their ETag
+    # like the requests session, as a private cache since the responses are per token
+    runner = asyncio.Runner()
+    cache_transport = hishel.httpx.AsyncCacheTransport(
+        next_transport=httpx.AsyncHTTPTransport(http2=True, limits=httpx.Limits(max_connections=64, max_keepalive_connections=32)),
+        storage=hishel.AsyncSqliteStorage(database_path=ASYNC_HTTP_CACHE_PATH),
+        policy=hishel.SpecificationPolicy(cache_options=hishel.CacheOptions(shared=False)))
+    client = httpx.AsyncClient(transport=cache_transport, timeout=30)
     '''
         Collecting repository information
     '''
     def fetch_repositories(url, headers):
         repos = []
+        # search pages are revalidated by the session on every call, a 304 does not use the search rate limit
         while url:
-            response = requests.get(url, headers=headers)
+            response = session.get(url, headers=headers, timeout=30)
             if response.status_code != 200:
                 print(f'Error: {response.status_code}')
                 break
@@ -72,7 +182,7 @@ def github_scraping(token, language, file_extension, time_year, time_start_month
         def check_rate_limit(token):
             url = 'https://api.github.com/rate_limit'
             headers = {'Authorization': f'token {token}'}
-            response = requests.get(url, headers=headers)
+            response = session.get(url, headers=headers, timeout=30)
             if response.status_code == 200:
                 rate_limit_info = response.json()
                 return rate_limit_info
@@ -93,131 +203,347 @@ def github_scraping(token, language, file_extension, time_year, time_start_month
             print(f"Search Limit resets at: {datetime.fromtimestamp(search_limit['reset'])}")
 
 
+    # rotate in one step, the header queue is shared by concurrent requests
+    def get_next_header():
+        header_queue.rotate(-1)
+        return header_queue[-1]
+    
+    def ignore_dir(curpath):
+        lower_path = curpath.rsplit('/', 1)[-1].lower()
+        if lower_path in ignore_set or ENV_DIR_RE.match(lower_path):
+            return True
+        return False
+    
+    '''
+    This error happen when the token exceed the search limit,
+    returns the next header to retry with
+    '''
+    def error403(response, headers):
+        report403(response, headers)
+        time.sleep(3)
+        return get_next_header()
+
+    # same as error403, without blocking the event loop while waiting
+    async def error403_async(response, headers):
+        report403(response, headers)
+        await asyncio.sleep(3)
+        return get_next_header()
+
+    def report403(response, headers):
+        reset_time = response.headers.get('X-RateLimit-Reset')
+        if reset_time:
+            wait_time = int(reset_time)-int(time.time()) + 1
+        else:
+            wait_time = 60  # Default wait time if header is missing
+        print(f"Rate limit exceeded for {headers}. need to wait for {wait_time} seconds. will wait 60 seconds and try next header")
+
     '''
-        Collecting files information in given repository
+        Collecting files information in given repository.
+        The requests are mostly waiting on the network, so they are sent concurrently
+        from one event loop over an HTTP/2 connection instead of one request at a time
     '''
     def fetch_files(repo, header_queue):
-        py_files = []
+        return runner.run(fetch_files_async(repo, header_queue))
+
+    async def fetch_files_async(repo, header_queue):
         repo_name = repo['full_name']
         repo_url = repo['html_url']
         contents_url = f'https://api.github.com/repos/{repo_name}/contents'
-        
-        def get_next_header():
-            header = header_queue.popleft()
-            header_queue.append(header)
-            return header
-        
         headers = header_queue[-1]
+        # requests in flight at once
+        semaphore = asyncio.Semaphore(max_workers)
+        # retry server errors and dropped connections with backoff, like the Retry of the requests session.
+        # returns None if the request still fails, the callers skip the directory or file
+        async def get(url, headers):
+            async with semaphore:
+                for attempt in range(5):
+                    if attempt:
+                        await asyncio.sleep(0.5 * 2 ** (attempt - 1))
+                    try:
+                        response = await client.get(url, headers=headers)
+                    except httpx.TransportError as error:
+                        response = error
+                        continue
+                    if response.status_code not in (502, 503, 504):
+                        break
+            if isinstance(response, httpx.TransportError):
+                print(f'Error fetching {url}: {response!r}')
+                return None
+            return response
 
-        def ignore_dir(curpath):
-            lower_path = curpath.rsplit('/', 1)[-1].lower()
-            if lower_path in ignore_filedir:
-                return True
-            if re.match(r'^venv\d+$', lower_path):
-                return True
-            if re.match(r'^env\d+$', lower_path):
-                return True
-            return False
-        
         '''
-        This error happen when the token exceed the search limit
+        Listing one directory, retrying with the next header on 403.
+        returns the files to fetch and the sub directories
         '''
-        def error403(response, headers, url):
-            reset_time = response.headers.get('X-RateLimit-Reset')
-            if reset_time:
-                wait_time = int(reset_time)-int(time.time()) + 1
-            else:
-                wait_time = 60  # Default wait time if header is missing
-            print(f"Rate limit exceeded for {headers}. need to wait for {wait_time} seconds. will wait 60 seconds and try next header")
-            time.sleep(3)
-            next_headers = get_next_header()
-            parse_contents(url, next_headers)  # Retry after waiting
-            return
-        
-        def parse_contents(url, headers):
-            response = requests.get(url, headers=headers)
-            if response.status_code == 403:
-                error403(response, headers, url)
-                return
+        async def parse_directory(url, headers):
+            file_items = []
+            subdirs = []
+            response = await get(url, headers)
+            while response is not None and response.status_code == 403:
+                headers = await error403_async(response, headers)
+                response = await get(url, headers)
+            if response is None:
+                return file_items, subdirs
             if response.status_code != 200:
                 print(f'Error fetching contents for {repo_name}: {response.status_code}')
-                return
+                return file_items, subdirs
             items = response.json()
             for item in items:
                 curpath = item['path']
-                cur_download_url = item['download_url']
                 if ignore_dir(curpath):
                     continue
-                if item['type'] == 'file' and any(item['name'].endswith(ext) for ext in file_extension):
-                    file_response = requests.get(cur_download_url, headers=headers)
-                    commits_url = f'https://api.github.com/repos/{repo_name}/commits?path={item["path"]}&per_page=100'
-                    commit_response = requests.get(commits_url, headers=headers)
-                    if file_response.status_code == 403:
-                        error403(file_response, headers, url)
-                        return
-                    if commit_response.status_code == 403:
-                        error403(commit_response, headers, url)
-                        return
-                    if file_response.status_code != 200:
-                        print(f'Error fetching file for {cur_download_url}: {file_response.status_code}')
-                        return
-                    if commit_response.status_code != 200:
-                        print(f'Error fetching commit for {cur_download_url}: {commit_response.status_code}')
-                        return
-                    
-                    commit_info = commit_response.json()
-                    find = False
-                    for cur_commit in commit_info:
-                        timestamp = cur_commit['commit']['committer']['date']
-                        cur_commit_time = datetime.fromisoformat(timestamp[:-1])
-                        '''
-                        If we want to find the file before ChatGPT was released,
-                        we need to loop the commit logs until find the commit date 
-                        before the ChatGPT release (setting the date to 2022-11-01)
-                        '''
-                        if afterGPT:
-                            py_files.append({
-                                'content': file_response.text,
-                                'timestamp': timestamp,
-                                'file_path': item['path'],
-                                'repo_name': repo_name,
-                                'repo_url': repo_url,
-                            })
-                            print('|', end='')
-                            break
-                        elif cur_commit_time < datetime(2022, 11, 1):
-                            find = True
-                            file_url = f'https://api.github.com/repos/{repo_name}/contents/{item["path"]}?ref={cur_commit["sha"]}'
-                            cur_file_response = requests.get(file_url, headers=headers)
-                            if cur_file_response.status_code == 403:
-                                error403(cur_file_response, headers, url)
-                                return
-                            if cur_file_response.status_code != 200:
-                                print(f'Error fetching current commit file for {file_url}: {cur_file_response.status_code}')
-                                return
-                            
-                            cur_file_content = cur_file_response.json()
-                            try:
-                                file_data = base64.b64decode(cur_file_content['content']).decode('utf-8')
-                            except UnicodeDecodeError:
-                                print(f'Error decoding file for {file_url}')
-                                continue
-                            py_files.append({
-                                'content': file_data,
-                                'timestamp': timestamp,
-                                'file_path': item['path'],
-                                'repo_name': repo_name,
-                                'repo_url': repo_url,
-                            })
-                            print('|', end='')
-                            break
-                    if not afterGPT and not find:
-                        print("TOO MANY COMMITS")
+                if item['type'] == 'file' and item['name'].endswith(file_extension):
+                    file_items.append(item)
                 elif item['type'] == 'dir':
-                    parse_contents(item['url'],headers)
+                    subdirs.append(item['url'])
+            return file_items, subdirs
 
+        '''
+        Fetching the content and commit time of one file.
+        returns the file information, or None if the file can not be fetched
+        '''
+        async def fetch_one_file(item):
+            cur_download_url = item['download_url']
+            headers = get_next_header()
+            commits_url = f'https://api.github.com/repos/{repo_name}/commits?path={item["path"]}&per_page=100'
+            while True:
+                file_response, commit_response = await asyncio.gather(get(cur_download_url, headers),
+                                                                      get(commits_url, headers))
+                if file_response is None or commit_response is None:
+                    return None
+                if file_response.status_code == 403:
+                    headers = await error403_async(file_response, headers)
+                    continue
+                if commit_response.status_code == 403:
+                    headers = await error403_async(commit_response, headers)
+                    continue
+                if file_response.status_code != 200:
+                    print(f'Error fetching file for {cur_download_url}: {file_response.status_code}')
+                    return None
+                if commit_response.status_code != 200:
+                    print(f'Error fetching commit for {cur_download_url}: {commit_response.status_code}')
+                    return None
+                break
+
+            commit_info = commit_response.json()
+            for cur_commit in commit_info:
+                timestamp = cur_commit['commit']['committer']['date']
+                cur_commit_time = datetime.fromisoformat(timestamp[:-1])
+                '''
+                If we want to find the file before ChatGPT was released,
+                we need to loop the commit logs until find the commit date 
+                before the ChatGPT release (setting the date to 2022-11-01)
+                '''
+                if afterGPT:
+                    content = file_response.text
+                    if item['name'].endswith('.ipynb'):
+                        content = notebook_to_source(file_response.content)
+                        if content is None:
+                            print(f'Error reading notebook {cur_download_url}')
+                            return None
+                    print('|', end='')
+                    return {
+                        'content': content,
+                        'timestamp': timestamp,
+                        'file_path': item['path'],
+                        'repo_name': repo_name,
+                        'repo_url': repo_url,
+                    }
+                elif cur_commit_time < datetime(2022, 11, 1):
+                    file_url = f'https://api.github.com/repos/{repo_name}/contents/{item["path"]}?ref={cur_commit["sha"]}'
+                    # ask for the raw file instead of base64 encoded json
+                    cur_file_response = await get(file_url, {**headers, 'Accept': RAW_MEDIA_TYPE})
+                    while cur_file_response is not None and cur_file_response.status_code == 403:
+                        headers = await error403_async(cur_file_response, headers)
+                        cur_file_response = await get(file_url, {**headers, 'Accept': RAW_MEDIA_TYPE})
+                    if cur_file_response is None:
+                        return None
+                    if cur_file_response.status_code != 200:
+                        print(f'Error fetching current commit file for {file_url}: {cur_file_response.status_code}')
+                        return None
+                    
+                    try:
+                        file_data = cur_file_response.content.decode('utf-8')
+                    except UnicodeDecodeError:
+                        print(f'Error decoding file for {file_url}')
+                        continue
+                    if item['name'].endswith('.ipynb'):
+                        file_data = notebook_to_source(file_data)
+                        if file_data is None:
+                            print(f'Error reading notebook {file_url}')
+                            continue
+                    print('|', end='')
+                    return {
+                        'content': file_data,
+                        'timestamp': timestamp,
+                        'file_path': item['path'],
+                        'repo_name': repo_name,
+                        'repo_url': repo_url,
+                    }
+            if not afterGPT:
+                print("TOO MANY COMMITS")
+            return None
+
+        # list the directories one level at a time, all directories of a level at once,
+        # then fetch every file at once
+        file_items = []
+        level = [contents_url]
+        while level:
+            listings = await asyncio.gather(*[parse_directory(url, headers) for url in level])
+            level = []
+            for items, subdirs in listings:
+                file_items.extend(items)
+                level.extend(subdirs)
+        # shas of the files returned for this repository
+        repo_shas = set()
+        '''
+        Fetching one file unless a file with the same content was already returned.
+        The sha is the one of the HEAD version, which is only the stored content after ChatGPT,
+        before it the content of an older commit is stored and the files are not deduplicated
+        '''
+        async def fetch_unique_file(item):
+            if not afterGPT:
+                return await fetch_one_file(item)
+            sha = item['sha']
+            # checked and reserved before the first await, copies inside the repository are fetched once
+            if sha in seen_shas or sha in repo_shas:
+                return None
+            repo_shas.add(sha)
+            py_file = await fetch_one_file(item)
+            if py_file is None:
+                repo_shas.discard(sha)
+            return py_file
+
+        py_files = await asyncio.gather(*[fetch_unique_file(item) for item in file_items])
+        seen_shas.update(repo_shas)
+        return [py_file for py_file in py_files if py_file is not None]
+
+    '''
+        Collecting files information in given repository with the GraphQL API.
+        One query returns GRAPHQL_TREE_DEPTH levels of the directory tree with the file shas,
+        one query per GRAPHQL_BLOB_BATCH kept files returns their text
+        and one per GRAPHQL_HISTORY_BATCH files returns their last commit time,
+        instead of several REST requests per directory and file.
+        Only used after ChatGPT, before it the commit log of every file is walked.
+        returns None if a query fails
+    '''
+    def fetch_files_graphql(repo):
+        py_files = []
+        repo_name = repo['full_name']
+        repo_url = repo['html_url']
+        owner, name = repo_name.split('/', 1)
+        headers = get_next_header()
+
+        def graphql(query, variables):
+            nonlocal headers
+            while True:
+                response = session.post(GRAPHQL_URL, json={'query': query, 'variables': variables},
+                                        headers=headers, timeout=60)
+                if response.status_code == 403:
+                    headers = error403(response, headers)
+                    continue
+                if response.status_code != 200:
+                    print(f'Error querying {repo_name}: {response.status_code}')
+                    return None
+                result = response.json()
+                if result.get('errors'):
+                    print(f'Error querying {repo_name}: {result["errors"][0].get("message")}')
+                    return None
+                return result['data']
+
+        # blobs are larger than the GraphQL text limit, download them from the REST API
+        def fetch_raw(path):
+            nonlocal headers
+            raw_url = f'https://api.github.com/repos/{repo_name}/contents/{path}'
+            while True:
+                response = session.get(raw_url, headers={**headers, 'Accept': RAW_MEDIA_TYPE}, timeout=30)
+                if response.status_code == 403:
+                    headers = error403(response, headers)
+                    continue
+                if response.status_code != 200:
+                    print(f'Error fetching file for {raw_url}: {response.status_code}')
+                    return None
+                return response.text
 
-        parse_contents(contents_url, headers)
+        # trees deeper than one query are queried again from their own path.
+        # the files to fetch by sha, copies inside the repository are fetched once
+        blobs = {}
+        # shas of the files returned for this repository
+        repo_shas = set()
+        queue = deque([''])
+        while queue:
+            data = graphql(GRAPHQL_TREE_QUERY, {'owner': owner, 'name': name, 'expression': f'HEAD:{queue.popleft()}'})
+            if data is None:
+                return None
+            tree = (data['repository'] or {}).get('object')
+            stack = [tree] if tree else []
+            while stack:
+                for entry in stack.pop()['entries']:
+                    if ignore_dir(entry['path']):
+                        continue
+                    entry_object = entry['object'] or {}
+                    if entry['type'] == 'tree':
+                        if 'entries' in entry_object:
+                            stack.append(entry_object)
+                        else:
+                            queue.append(entry['path'])
+                    elif entry['type'] == 'blob' and entry['name'].endswith(file_extension):
+                        oid = entry_object['oid']
+                        if entry_object.get('isBinary') or oid in seen_shas or oid in blobs:
+                            continue
+                        blobs[oid] = (entry['path'], entry_object.get('byteSize') or 0)
+
+        # the text of the files, in batches of at most GRAPHQL_BLOB_BATCH files and GRAPHQL_BLOB_BATCH_BYTES
+        batches = []
+        batch_bytes = 0
+        for oid, (path, size) in blobs.items():
+            if not batches or len(batches[-1]) == GRAPHQL_BLOB_BATCH or batch_bytes + size > GRAPHQL_BLOB_BATCH_BYTES:
+                batches.append([])
+                batch_bytes = 0
+            batches[-1].append((path, oid))
+            batch_bytes += size
+        files = []
+        for batch in batches:
+            data = graphql(_blob_query(len(batch)), {'owner': owner, 'name': name,
+                                                     **{f'p{i}': f'HEAD:{path}' for i, (path, _) in enumerate(batch)}})
+            if data is None:
+                return None
+            for i, (path, oid) in enumerate(batch):
+                blob = data['repository'][f'f{i}'] or {}
+                text = blob.get('text')
+                if text is None or blob.get('isTruncated'):
+                    text = fetch_raw(path)
+                    if text is None:
+                        continue
+                if path.endswith('.ipynb'):
+                    text = notebook_to_source(text)
+                    if text is None:
+                        print(f'Error reading notebook {path} of {repo_name}')
+                        continue
+                files.append((path, text, oid))
+
+        for start in range(0, len(files), GRAPHQL_HISTORY_BATCH):
+            batch = files[start:start + GRAPHQL_HISTORY_BATCH]
+            data = graphql(_history_query(len(batch)), {'owner': owner, 'name': name,
+                                                        **{f'p{i}': path for i, (path, _, _) in enumerate(batch)}})
+            if data is None:
+                return None
+            history = data['repository']['object']
+            for i, (path, text, sha) in enumerate(batch):
+                commits = history[f'f{i}']['nodes']
+                if not commits or sha in repo_shas:
+                    continue
+                repo_shas.add(sha)
+                py_files.append({
+                    'content': text,
+                    'timestamp': commits[0]['committedDate'],
+                    'file_path': path,
+                    'repo_name': repo_name,
+                    'repo_url': repo_url,
+                })
+                print('|', end='')
+        # only marked as seen once the repository succeeded, the REST fallback fetches them again otherwise
+        seen_shas.update(repo_shas)
         return py_files
 
     chunk_index_size = 4
@@ -226,31 +552,41 @@ def github_scraping(token, language, file_extension, time_year, time_start_month
     total_py_files = []
     
     
-    for chunk_index in range(chunk_index_size):
-        all_py_files = []
-        progress_index = 0
-        chunk_size = len(chunks[chunk_index])
-        # loop through repositories and fetch files
-        for repo in chunks[chunk_index]:
-            py_files = fetch_files(repo, header_queue)
-            print()
-            for t in token:
-                show_request_status(t)
+    try:
+        for chunk_index in range(chunk_index_size):
+            all_py_files = []
+            progress_index = 0
+            chunk_size = len(chunks[chunk_index])
+            # loop through repositories and fetch files
+            for repo in chunks[chunk_index]:
+                py_files = None
+                if afterGPT and use_graphql:
+                    py_files = fetch_files_graphql(repo)
+                if py_files is None:
+                    py_files = fetch_files(repo, header_queue)
                 print()
-            all_py_files.extend(py_files)
-            progress_index += 1
-            print(f'Progress: {progress_index}/{chunk_size}')
-            print("++++++++++++++++++++++++++++")
-
-        if not os.path.exists(f"{parent_dir}/files_in_chunk"):
-            os.makedirs(f"{parent_dir}/files_in_chunk")
-        # save to parquet file
-        df = pd.DataFrame(all_py_files)
-        table = pa.Table.from_pandas(df)
-        pq.write_table(table, f'{parent_dir}/files_in_chunk/{file_name}_chunk{chunk_index}.parquet')
-
-        print(f'Total files fetched: {len(all_py_files)}')
-        total_py_files.extend(all_py_files)
+                for t in token:
+                    show_request_status(t)
+                    print()
+                all_py_files.extend(py_files)
+                progress_index += 1
+                print(f'Progress: {progress_index}/{chunk_size}')
+                print("++++++++++++++++++++++++++++")
+
+            if not os.path.exists(f"{parent_dir}/files_in_chunk"):
+                os.makedirs(f"{parent_dir}/files_in_chunk")
+            # save to parquet file
+            df = pd.DataFrame(all_py_files)
+            table = pa.Table.from_pandas(df)
+            pq.write_table(table, f'{parent_dir}/files_in_chunk/{file_name}_chunk{chunk_index}.parquet',
+                           row_group_size=FILES_ROW_GROUP_SIZE, **FILES_WRITE_OPTIONS)
+
+            print(f'Total files fetched: {len(all_py_files)}')
+            total_py_files.extend(all_py_files)
+    finally:
+        # the async client lives as long as the event loop running fetch_files
+        runner.run(client.aclose())
+        runner.close()
     return total_py_files
 
 # Example
@@ -0,0 +1,26 @@
+'''
+    Parquet writer settings shared by github_scraping and extract_functions,
+    kept apart so the scraper does not import tree-sitter with extract_functions
+'''
+
+# rows per row group of the written parquets, around 10MB of function code or file content,
+# small enough for readers to go through the files a row group at a time
+FUNCTIONS_ROW_GROUP_SIZE = 16384
+FILES_ROW_GROUP_SIZE = 2048
+# parquet writer options of the functions parquet, statistics let readers skip row groups
+# and the low cardinality columns are dictionary encoded
+FUNCTIONS_WRITE_OPTIONS = {
+    'compression': 'zstd',
+    'compression_level': 3,
+    'use_dictionary': ['function_name', 'file_path', 'repo_name', 'repo_url'],
+    'data_page_size': 1 << 20,
+    'write_statistics': True,
+}
+# parquet writer options of the python files parquets, the chunks written by github_scraping and the merged file
+FILES_WRITE_OPTIONS = {
+    'compression': 'zstd',
+    'compression_level': 3,
+    'use_dictionary': ['repo_name', 'repo_url'],
+    'data_page_size': 1 << 20,
+    'write_statistics': True,
+}
@@ -1,53 +1,201 @@
-import pandas as pd
+import matplotlib
+# non interactive backend, the plots are only saved to files
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
+from matplotlib.ticker import MaxNLocator
 import numpy as np
 import os
-import seaborn as sns
 import glob
+import hashlib
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from numba import njit, prange
+
+# figure reused for every histogram drawn by the process, created by _get_figure
+_figure = None
+# edges of the histogram bins, the code lengths are clipped into the last bin
+BIN_EDGES = np.array([0, 11, 21, 31, 41, 51, 61, 71, 81, 91, 101, 201, 301, 401], dtype=np.int32)
+CLIP_LENGTH = BIN_EDGES[-2]
+NUM_BINS = len(BIN_EDGES) - 1
+# columns read from the functions parquet files, code_length is a line count and fits in int32,
+# half the bytes of int64 go through the bincount. it is clipped by arrow while scanning
+HISTOGRAM_COLUMNS = {
+        'file_path': ds.field('file_path'),
+        'code_length': pc.min_element_wise(ds.field('code_length').cast(pa.int32()), pa.scalar(int(CLIP_LENGTH), pa.int32())),
+}
+# files with fewer functions are not plotted, their histograms show almost nothing
+MIN_FUNCS = 2
+XTICK_LABELS = ['1-10', '11-20', '21-30', '31-40', '41-50', '51-60', '61-70', '71-80', '81-90', '91-100', '101-200', '201-300', '300+']
+
+'''
+bin index of one code length, the same bins as np.histogram with BIN_EDGES.
+the first 10 bins are 10 wide, so their index is computed directly,
+lengths above 300 all go to the last bin
+'''
+@njit(cache=True)
+def _bin_of(code_length):
+        if code_length <= 100:
+                return max(code_length - 1, 0) // 10
+        if code_length <= 200:
+                return 10
+        if code_length <= 300:
+                return 11
+        return 12
+
+'''
+count the histogram of one file in one pass over its functions,
+the bin and the count of each function are done together without temporary arrays
+
+paramters:
+        code_lengths: the code length of each function of the file
+'''
+@njit(cache=True)
+def hist13(code_lengths):
+        counts = np.zeros(NUM_BINS, np.int64)
+        for code_length in code_lengths:
+                counts[_bin_of(code_length)] += 1
+        return counts
+
+'''
+count the histograms of all files, the files are counted in parallel threads
+
+paramters:
+        code_lengths: the code length of each function, sorted by file
+        offsets: the start of the functions of each file in code_lengths, and the end of the last file
+'''
+@njit(parallel=True, cache=True)
+def file_histograms(code_lengths, offsets):
+        all_counts = np.zeros((len(offsets) - 1, NUM_BINS), np.int64)
+        for i in prange(len(offsets) - 1):
+                all_counts[i] = hist13(code_lengths[offsets[i]:offsets[i + 1]])
+        return all_counts
+
+'''
+get the figure and axes of this process, the axes are cleared for the next histogram
+'''
+def _get_figure():
+        global _figure
+        if _figure is None:
+                _figure = plt.subplots(figsize=(12, 6))
+        fig, ax = _figure
+        ax.clear()
+        return fig, ax
+
+'''
+signature of a histogram, saved next to its png file to know if the png is up to date
+
+paramters:
+        file_path: the python file path, the title of the histogram
+        counts: the counts of each bin
+'''
+def _signature(file_path, counts):
+        return hashlib.blake2b(file_path.encode() + counts.tobytes(), digest_size=8).hexdigest()
+
+'''
+check if the histogram saved in save_path was drawn with the given signature
+'''
+def _is_up_to_date(save_path, signature):
+        if not os.path.exists(save_path):
+                return False
+        try:
+                with open(f'{save_path}.sig') as f:
+                        return f.read() == signature
+        except FileNotFoundError:
+                return False
+
+'''
+draw and save the histogram of one python file from its bin counts
+
+paramters:
+        task: tuple of the file path, the counts of each bin, the path to save histogram and its signature
+'''
+def _render_one(task):
+        file_path, counts, save_path, signature = task
+        fig, ax = _get_figure()
+        # the counts are already aggregated, draw the bars directly
+        ax.bar(XTICK_LABELS, counts, color="skyblue")
+        ax.set_xlabel('Code Length')
+        ax.set_ylabel('Count')
+        # integer ticks picked by matplotlib, one tick per count is too many for large files
+        ax.yaxis.set_major_locator(MaxNLocator(integer=True))
+        ax.set_title(file_path)
+        # lower resolution and fast zlib level, encoding the png is most of the time spent per histogram
+        fig.savefig(save_path, dpi=80, pil_kwargs={'compress_level': 1})
+        # written after the png, so an interrupted save is drawn again on the next run
+        with open(f'{save_path}.sig', 'w') as f:
+                f.write(signature)
+
 '''
 plot histogram by given python file
 
 paramters:
-        df: pandas dataframe, contains the code length of each function
+        table: pyarrow table, contains the code length of each function clipped to CLIP_LENGTH and its dictionary encoded file path
         parent_dir: the parent directory to save histogram
         detailed_dir: the detailed directory to save histogram
+        max_workers: the number of processes drawing the histograms
 '''
-def plot_histogram(df, parent_dir, detailed_dir):
-        grouped = df.groupby('file_path')
-        bins = [0,11, 21, 31, 41, 51, 61, 71, 81, 91, 101, 201, 301, 401]
-        xticks = bins
-        xtick_labels = ['1-10', '11-20', '21-30', '31-40', '41-50', '51-60', '61-70', '71-80', '81-90', '91-100', '101-200', '201-300', '300+']
+def plot_histogram(table, parent_dir, detailed_dir, max_workers=None):
         save_parent_path =  f'{parent_dir}/histogram/{detailed_dir}'
-        if not os.path.exists(save_parent_path):
-                os.makedirs(save_parent_path)
-        for file_path, group in grouped:
-                code_lengths = group['code_length'].apply(lambda x: min(x, 301)).tolist()
-                counts, bin_edges = np.histogram(code_lengths, bins=bins)
-                df_hist = pd.DataFrame({
-                'bin': pd.cut(code_lengths, bins=bins, labels=xtick_labels, right=False),
-                'count': code_lengths
-                }) 
-                df_hist = df_hist.groupby('bin').size().reset_index(name='count') 
-                plt.figure(figsize=(12, 6))
-                sns.barplot(x='bin', y='count', data=df_hist, color="skyblue")
-                plt.xlabel('Code Length')
-                plt.ylabel('Count')
-                max_count = df_hist['count'].max()
-                plt.yticks(np.arange(0, max_count + 1, step=1))
-                plt.title(file_path)
-                save_path = file_path.replace('/', '_')
-                save_path = save_path.rsplit('.', 1)[0]
-                plt.savefig(f'{save_parent_path}/{save_path}_histogram.png')
-                plt.close()
-
-# list of directores to process
-query_directories = ['ecommerce', 'blog', 'social_media', 'data_visualization']
-
-# loop through directories and plot histograms
-for query_dir in query_directories:
+        os.makedirs(save_parent_path, exist_ok=True)
+        # the dictionary indices of file_path are used as the index of each file, and the dictionary as the file paths,
+        # the columns are used as numpy arrays without building a dataframe
+        file_path_column = table.unify_dictionaries().column('file_path').combine_chunks()
+        codes = file_path_column.indices.to_numpy()
+        file_paths = file_path_column.dictionary.to_pandas()
+        code_lengths = table.column('code_length').to_numpy()
+        # group the functions by file, the functions of a file are mostly stored together already
+        order = np.argsort(codes, kind='stable')
+        offsets = np.zeros(len(file_paths) + 1, np.int64)
+        np.cumsum(np.bincount(codes, minlength=len(file_paths)), out=offsets[1:])
+        # histograms of all files at once
+        all_counts = file_histograms(code_lengths[order], offsets)
+        keep = all_counts.sum(axis=1) >= MIN_FUNCS
+        file_paths, all_counts = file_paths[keep], all_counts[keep]
+        # histogram file names of all files at once, the path without extension and / replaced by _
+        save_paths = f'{save_parent_path}/' + file_paths.str.replace('/', '_', regex=False).str.rsplit('.', n=1).str[0] + '_histogram.png'
+        # the histograms whose counts did not change since the last run are not drawn again
+        tasks = []
+        for file_path, counts, save_path in zip(file_paths, all_counts, save_paths):
+                signature = _signature(file_path, counts)
+                if not _is_up_to_date(save_path, signature):
+                        tasks.append((file_path, counts, save_path, signature))
+        if not tasks:
+                return
+        # drawing and encoding the png files is the slow part, it is done in parallel.
+        # the workers are started by a forkserver, forking this process after numba started
+        # the threads of file_histograms keeps it from exiting
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('forkserver')) as executor:
+                list(executor.map(_render_one, tasks, chunksize=32))
+
+'''
+plot the histograms of every functions parquet file in the directory
+
+paramters:
+        query_dir: the directory of the functions parquet files, the histograms are saved in it
+        max_workers: the number of processes drawing the histograms
+'''
+def process_dir(query_dir, max_workers=None):
         parquet_files = glob.glob(os.path.join(query_dir, 'functions/*.parquet'))
-        for parquet_file in parquet_files:
-            df = pd.read_parquet(parquet_file)
-            detailed_dir = parquet_file.rsplit('/', 1)[-1]
-            plot_histogram(df, query_dir,detailed_dir)
-            print(f'Finished plotting histograms for {query_dir}/{detailed_dir}')
\ No newline at end of file
+        # scan each file of the directory lazily, only the columns used for the histogram are read and decoded
+        # file_path is read dictionary encoded, as it is stored
+        file_format = ds.ParquetFileFormat(read_options=ds.ParquetReadOptions(dictionary_columns=['file_path']))
+        dataset = ds.dataset(parquet_files, format=file_format)
+        for fragment in dataset.get_fragments():
+            table = fragment.to_table(columns=HISTOGRAM_COLUMNS)
+            detailed_dir = fragment.path.rsplit('/', 1)[-1]
+            plot_histogram(table, query_dir,detailed_dir, max_workers=max_workers)
+            print(f'Finished plotting histograms for {query_dir}/{detailed_dir}')
+
+if __name__ == '__main__':
+        # list of directores to process
+        query_directories = ['ecommerce', 'blog', 'social_media', 'data_visualization']
+
+        # the directories are independent, plot their histograms in parallel,
+        # and share the cores between the processes drawing the histograms of each directory
+        max_workers = max(1, (os.cpu_count() or 1) // len(query_directories))
+        with ProcessPoolExecutor(max_workers=len(query_directories)) as executor:
+                list(executor.map(process_dir, query_directories, repeat(max_workers)))